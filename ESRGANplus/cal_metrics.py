@@ -1,88 +1,159 @@
 import os
-import cv2
-import numpy as np
-from skimage.metrics import peak_signal_noise_ratio as psnr
-from skimage.metrics import structural_similarity as ssim
+import re
+import logging
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from metric_utils import (USE_GPU, is_image_name, read_image, read_cached_image, resize_like,
+                          prefetch, limit_threads, setup_logging, fast_psnr, fast_ssim, score_gpu_batches)
 
-def calculate_metrics(results_dir, hr_dir):
-    """Calculate PSNR and SSIM between enhanced and ground truth images"""
+logger = logging.getLogger(__name__)
+
+# Scale tag the LR naming scheme leaves on result names, e.g. the x4 in 0801x4_rlt.png
+SCALE_SUFFIX = re.compile(r'x\d+$')
+
+def list_images(directory):
+    """Sorted names of the image files in a directory"""
+    with os.scandir(directory) as entries:
+        return sorted(e.name for e in entries if e.is_file() and is_image_name(e.name))
+
+def find_hr_file(base_name, hr_by_stem):
+    """Find the HR file for a result name, stripping _suffixes and xN scale tags until a stem matches"""
+    stem = base_name
+    while True:
+        for candidate in (stem, SCALE_SUFFIX.sub('', stem)):
+            if candidate in hr_by_stem:
+                return hr_by_stem[candidate]
+        stem, sep, _ = stem.rpartition('_')
+        if not sep:
+            return None
+
+def load_pair(res_path, hr_path, resize_buffers=None):
+    """Read a result/HR pair as same-sized uint8 images, or None if unreadable
+
+    A resized result is written into resize_buffers (see resize_like) when given, so
+    it is only valid until the next call with the same buffers
+    """
+    img_res = read_image(res_path)
+    img_hr = read_cached_image(hr_path)
+    
+    if img_res is None:
+        logger.warning("Could not read result image %s", res_path)
+        return None
+    if img_hr is None:
+        logger.warning("Could not read HR image %s", hr_path)
+        return None
+    
+    # Make sure images are the same size
+    if img_res.shape != img_hr.shape:
+        logger.debug("Resizing %s to match %s dimensions", os.path.basename(res_path), os.path.basename(hr_path))
+        img_res = resize_like(img_res, img_hr, resize_buffers)
+    
+    return img_hr, img_res
+
+# Resize buffers reused across the pairs scored by one worker process
+_resize_buffers = {}
+
+def _init_worker():
+    """Keep each pool worker single-threaded; the pool already uses every core"""
+    limit_threads()
+
+def _score_pair(res_path, hr_path):
+    """Calculate (PSNR, SSIM) for one result/HR pair; runs in a worker process"""
+    images = load_pair(res_path, hr_path, _resize_buffers)
+    if images is None:
+        return None
+    img_hr, img_res = images
+    
+    try:
+        current_psnr = fast_psnr(img_hr, img_res)
+        current_ssim = fast_ssim(img_hr, img_res)
+    except Exception as e:
+        logger.error("Error calculating metrics for %s: %s", res_path, e)
+        return None
+    
+    return current_psnr, current_ssim
+
+def score_pairs(pairs):
+    """Yield (PSNR, SSIM), or None on failure, for each (res_file, res_path, hr_path) pair in order"""
+    res_paths = [res_path for _, res_path, _ in pairs]
+    if USE_GPU:
+        # Decode upcoming pairs on background threads while the GPU scores the current batch
+        path_pairs = [(res_path, hr_path) for _, res_path, hr_path in pairs]
+        yield from score_gpu_batches(prefetch(load_pair, path_pairs), res_paths)
+    else:
+        # Every pair is independent, so score them on all cores
+        hr_paths = [hr_path for _, _, hr_path in pairs]
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker) as executor:
+            yield from executor.map(_score_pair, res_paths, hr_paths, chunksize=4)
+
+def calculate_metrics(results_dir, hr_dir, csv_file=None):
+    """Calculate PSNR and SSIM between enhanced and ground truth images, writing CSV rows to csv_file if given"""
     print(f"Checking directories:\nResults: {results_dir}\nHR: {hr_dir}")
+    if csv_file is not None:
+        csv_file.write("PSNR,SSIM\n")
     
     # Get list of image files
-    result_files = sorted([f for f in os.listdir(results_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))])
-    hr_files = sorted([f for f in os.listdir(hr_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))])
+    result_files = list_images(results_dir)
+    hr_files = list_images(hr_dir)
     
     print(f"\nFound {len(result_files)} result files and {len(hr_files)} HR files")
     
     if not result_files:
         print(f"Error: No images found in results directory: {results_dir}")
-        return [], []
+        return array('d'), array('d')
     if not hr_files:
         print(f"Error: No images found in HR directory: {hr_dir}")
-        return [], []
-    
-    psnr_values = []
-    ssim_values = []
+        return array('d'), array('d')
     
+    # Match every result file to its HR file before scoring
+    hr_by_stem = {os.path.splitext(f)[0]: f for f in hr_files}
+    pairs = []
     for res_file in result_files:
         # Find matching HR file (remove possible suffixes added during processing)
         base_name = os.path.splitext(res_file)[0]
-        hr_file = next((f for f in hr_files if os.path.splitext(f)[0] in base_name), None)
+        hr_file = find_hr_file(base_name, hr_by_stem)
         
         if not hr_file:
-            print(f"No matching HR file found for {res_file}")
+            logger.warning("No matching HR file found for %s", res_file)
             continue
             
-        print(f"\nProcessing {res_file} vs {hr_file}")
-        
-        # Read images
-        res_path = os.path.join(results_dir, res_file)
-        hr_path = os.path.join(hr_dir, hr_file)
-        
-        img_res = cv2.imread(res_path)
-        img_hr = cv2.imread(hr_path)
-        
-        if img_res is None:
-            print(f"Warning: Could not read result image {res_path}")
-            continue
-        if img_hr is None:
-            print(f"Warning: Could not read HR image {hr_path}")
-            continue
-        
-        # Make sure images are the same size
-        if img_res.shape != img_hr.shape:
-            print(f"Resizing {res_file} to match {hr_file} dimensions")
-            img_res = cv2.resize(img_res, (img_hr.shape[1], img_hr.shape[0]))
-        
-        # Convert to float32 and scale to 0-1 range
-        img_res = img_res.astype(np.float32) / 255.0
-        img_hr = img_hr.astype(np.float32) / 255.0
-        
-        # Calculate metrics
-        try:
-            current_psnr = psnr(img_hr, img_res, data_range=1.0)
-            current_ssim = ssim(img_hr, img_res, data_range=1.0, channel_axis=2)
-            
-            psnr_values.append(current_psnr)
-            ssim_values.append(current_ssim)
-            
-            print(f"PSNR: {current_psnr:.4f} dB, SSIM: {current_ssim:.4f}")
-        except Exception as e:
-            print(f"Error calculating metrics: {str(e)}")
+        logger.debug("Processing %s vs %s", res_file, hr_file)
+        pairs.append((res_file, os.path.join(results_dir, res_file), os.path.join(hr_dir, hr_file)))
+    
+    # Values are kept as packed doubles, and each row is written as soon as it is scored
+    psnr_values = array('d')
+    ssim_values = array('d')
+    psnr_sum = ssim_sum = 0.0
+    
+    for (res_file, _, _), result in zip(pairs, score_pairs(pairs)):
+        if result is None:
             continue
+        current_psnr, current_ssim = result
+        psnr_values.append(current_psnr)
+        ssim_values.append(current_ssim)
+        psnr_sum += current_psnr
+        ssim_sum += current_ssim
+        logger.debug("%s - PSNR: %.4f dB, SSIM: %.4f", res_file, current_psnr, current_ssim)
+        if csv_file is not None:
+            csv_file.write(f"{current_psnr:.4f},{current_ssim:.4f}\n")
     
     if psnr_values and ssim_values:
-        avg_psnr = np.mean(psnr_values)
-        avg_ssim = np.mean(ssim_values)
+        avg_psnr = psnr_sum / len(psnr_values)
+        avg_ssim = ssim_sum / len(ssim_values)
         print("\nAverage Metrics:")
         print(f"PSNR: {avg_psnr:.4f} dB")
         print(f"SSIM: {avg_ssim:.4f}")
+        if csv_file is not None:
+            csv_file.write(f"\nAverage PSNR: {avg_psnr:.4f} dB\n")
+            csv_file.write(f"Average SSIM: {avg_ssim:.4f}\n")
     else:
         print("\nNo valid metric values were calculated.")
     
     return psnr_values, ssim_values
 
 if __name__ == "__main__":
+    setup_logging(logger)
+    
     # Use absolute paths to be sure
     project_root = os.path.dirname(os.path.abspath(__file__))
     results_directory = os.path.join(project_root, "test_image", "results")
@@ -106,16 +177,9 @@ if __name__ == "__main__":
         print(f"Trying: {hr_directory}")
     
     if os.path.exists(results_directory) and os.path.exists(hr_directory):
-        psnr_values, ssim_values = calculate_metrics(results_directory, hr_directory)
-        
-        # Save results to file
-        with open(os.path.join(project_root, "metrics_results.txt"), "w") as f:
-            f.write("PSNR,SSIM\n")
-            for p, s in zip(psnr_values, ssim_values):
-                f.write(f"{p:.4f},{s:.4f}\n")
-            if psnr_values:
-                f.write(f"\nAverage PSNR: {np.mean(psnr_values):.4f} dB\n")
-                f.write(f"Average SSIM: {np.mean(ssim_values):.4f}\n")
+        # Save results to file as they are calculated
+        with open(os.path.join(project_root, "metrics_results.txt"), "w", buffering=1 << 16) as f:
+            calculate_metrics(results_directory, hr_directory, csv_file=f)
         print("\nMetrics saved to metrics_results.txt")
     else:
         print("\nCannot proceed - directories not found")
@@ -0,0 +1,361 @@
+'''
+Image I/O and PSNR/SSIM kernels shared by cal_metrics.py and test_image/calculate_metrics.py.
+Images are BGR uint8 throughout; the metrics use data_range=255.
+'''
+import os
+import re
+import math
+import sys
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+try:
+    from numba import njit, prange, set_num_threads
+    USE_NUMBA = True
+except ImportError:
+    USE_NUMBA = False
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError):
+    # PyTurboJPEG missing, or installed without the libturbojpeg shared library
+    turbo_jpeg = None
+
+try:
+    import torch
+    from pytorch_msssim import ssim as gpu_ssim
+    USE_GPU = torch.cuda.is_available()
+except ImportError:
+    USE_GPU = False
+
+cv2.setUseOptimized(True)
+
+logger = logging.getLogger(__name__)
+
+# Image file extensions picked up when listing directories
+IMAGE_EXTS = frozenset({'png', 'jpg', 'jpeg', 'bmp'})
+
+# Directory, inside a reference image folder, holding decoded copies of its images
+IMAGE_CACHE_DIR = '.cache'
+
+# Number of image pairs decoded ahead of the one being scored
+PREFETCH_DEPTH = 4
+
+# Number of same-shape image pairs sent to the GPU in one SSIM call
+GPU_BATCH_SIZE = 8
+
+# Most image pairs held in GPU buckets at once; past this the bucket with the oldest pair is scored early
+GPU_MAX_PENDING = 4 * GPU_BATCH_SIZE
+
+# 11x11 Gaussian SSIM window (sigma 1.5) as a separable kernel, built once for every filter call
+SSIM_WINDOW = 11
+GAUSSIAN_KERNEL = cv2.getGaussianKernel(SSIM_WINDOW, 1.5).astype(np.float32)
+
+
+####################
+# logging
+####################
+
+
+def setup_logging(script_logger):
+    """Log to stdout with level prefixes; METRICS_VERBOSE=1 also shows script_logger's per-image DEBUG lines"""
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s', stream=sys.stdout)
+    if os.environ.get('METRICS_VERBOSE', '0') != '0':
+        script_logger.setLevel(logging.DEBUG)
+
+
+####################
+# image I/O
+####################
+
+
+def is_image_name(name):
+    """Whether a file name has one of the IMAGE_EXTS extensions"""
+    _, sep, ext = name.rpartition('.')
+    return bool(sep) and ext.lower() in IMAGE_EXTS
+
+
+def read_image(path):
+    """Read an image as BGR uint8 like cv2.imread, decoding JPEGs with libjpeg-turbo when available"""
+    if turbo_jpeg is not None and path.lower().endswith(('.jpg', '.jpeg')):
+        try:
+            with open(path, 'rb') as f:
+                return turbo_jpeg.decode(f.read(), pixel_format=TJPF_BGR)
+        except OSError:
+            pass  # let cv2.imread have a go and report failure the usual way
+    return cv2.imread(path)
+
+
+def _remove_stale_caches(cache_dir, name, cache_path):
+    """Delete the cached copies of an image other than cache_path, left behind by earlier versions of it"""
+    stale = re.compile(re.escape(name) + r'\.\d+\.\d+\.npy$')
+    with os.scandir(cache_dir) as entries:
+        for e in entries:
+            if e.path != cache_path and stale.match(e.name):
+                try:
+                    os.remove(e.path)
+                except OSError:
+                    pass  # e.g. already removed by another reader
+
+
+def read_cached_image(path):
+    """Read an image through a .npy copy in a cache directory next to it, memory-mapped once it exists"""
+    cache_dir = os.path.join(os.path.dirname(path), IMAGE_CACHE_DIR)
+    name = os.path.basename(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return read_image(path)  # let the reader report the missing file the usual way
+    # Name the copy after the source's exact size and mtime, so a replaced source
+    # (even one with an older mtime, as cp -p or rsync -a leave) never hits it
+    cache_path = os.path.join(cache_dir, f"{name}.{st.st_size}.{st.st_mtime_ns}.npy")
+    try:
+        return np.load(cache_path, mmap_mode='r')
+    except (OSError, ValueError, EOFError):
+        pass  # no cache yet, or a corrupt/empty one: decode and rebuild it
+
+    img = read_image(path)
+    if img is not None:
+        # Write under a private name first so concurrent readers never see a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, img)
+            os.replace(tmp_path, cache_path)
+            _remove_stale_caches(cache_dir, name, cache_path)
+        except OSError:
+            # e.g. a read-only directory or a full disk; the decoded image is still usable
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return img
+
+
+def resize_like(img, ref, buffers=None):
+    """Resize img to the size of ref; given a dict of buffers, write into one reused buffer per shape"""
+    h, w = ref.shape[:2]
+    if buffers is None:
+        return cv2.resize(img, (w, h))
+    shape = (h, w) + img.shape[2:]
+    buf = buffers.get(shape)
+    if buf is None:
+        buf = buffers[shape] = np.empty(shape, img.dtype)
+    return cv2.resize(img, (w, h), dst=buf)
+
+
+def prefetch(load, path_pairs, depth=PREFETCH_DEPTH):
+    """Yield load(*paths) for each pair in order while up to `depth` later loads run in the background"""
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = deque()
+        for paths in path_pairs:
+            futures.append(executor.submit(load, *paths))
+            if len(futures) > depth:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def limit_threads():
+    """Keep OpenCV and numba single-threaded, for callers that already use one process per core"""
+    cv2.setNumThreads(1)
+    if USE_NUMBA:
+        set_num_threads(1)
+
+
+####################
+# CPU metrics
+####################
+
+
+def _ssim_reduce_numpy(mu1, mu2, mu11, mu22, mu12, C1, C2):
+    """Mean SSIM over the valid region from the blurred first and second moments, all HxWxC float32"""
+    mu1_sq = mu1 * mu1
+    mu2_sq = mu2 * mu2
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = mu11 - mu1_sq
+    sigma2_sq = mu22 - mu2_sq
+    sigma12 = mu12 - mu1_mu2
+
+    ssim_map = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) * (sigma1_sq + sigma2_sq + C2))
+    # Keep only the valid region, where the window fits inside the image
+    pad = SSIM_WINDOW // 2
+    return ssim_map[pad:-pad, pad:-pad].mean()
+
+
+if USE_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def ssim_reduce(mu1, mu2, mu11, mu22, mu12, C1, C2):
+        """Same as _ssim_reduce_numpy, fused into a single pass without temporary buffers"""
+        H, W, C = mu1.shape
+        pad = SSIM_WINDOW // 2
+        total = 0.0
+        for i in prange(pad, H - pad):
+            for j in range(pad, W - pad):
+                for c in range(C):
+                    m1 = mu1[i, j, c]
+                    m2 = mu2[i, j, c]
+                    m12 = m1 * m2
+                    num = (2 * m12 + C1) * (2 * (mu12[i, j, c] - m12) + C2)
+                    den = (m1 * m1 + m2 * m2 + C1) * (mu11[i, j, c] - m1 * m1 + mu22[i, j, c] - m2 * m2 + C2)
+                    total += num / den
+        return total / ((H - 2 * pad) * (W - 2 * pad) * C)
+else:
+    ssim_reduce = _ssim_reduce_numpy
+
+
+# Filter outputs stay float32. 16-bit fixed-point outputs were measured on a 2K image:
+# uint8 -> CV_16U filters 2.6x slower than -> CV_32F, and uint16 products filter slower
+# than float32 ones. uint8 -> CV_16S is ~10% faster for the means but needs a x128
+# kernel scale, which quantizes mu to 1/128 before the variance cancellation.
+def gaussian_filter(img):
+    """Blur with the SSIM Gaussian window into a float32 image, whatever the input depth"""
+    return cv2.sepFilter2D(img, cv2.CV_32F, GAUSSIAN_KERNEL, GAUSSIAN_KERNEL, borderType=cv2.BORDER_REFLECT)
+
+
+def fast_psnr(x, y, data_range=255):
+    """PSNR from a single-pass cv2.norm squared L2 distance"""
+    mse = cv2.norm(x, y, cv2.NORM_L2SQR) / x.size
+    if mse == 0:
+        return float('inf')
+    return 10 * math.log10(data_range ** 2 / mse)
+
+
+def check_ssim_size(img):
+    """Raise ValueError if an image is smaller than the SSIM window, like skimage does"""
+    if min(img.shape[:2]) < SSIM_WINDOW:
+        raise ValueError(f"SSIM needs images of at least {SSIM_WINDOW}x{SSIM_WINDOW} pixels, "
+                         f"got {img.shape[0]}x{img.shape[1]}")
+
+
+def fast_ssim(x, y, data_range=255):
+    """SSIM with an 11x11 Gaussian window (sigma 1.5) on OpenCV filters, averaged over channels"""
+    check_ssim_size(x)
+    C1 = (0.01 * data_range) ** 2
+    C2 = (0.03 * data_range) ** 2
+
+    # Filter the uint8 inputs straight to float32; products are widened as they are formed
+    moments = [gaussian_filter(x), gaussian_filter(y),
+               gaussian_filter(cv2.multiply(x, x, dtype=cv2.CV_32F)),
+               gaussian_filter(cv2.multiply(y, y, dtype=cv2.CV_32F)),
+               gaussian_filter(cv2.multiply(x, y, dtype=cv2.CV_32F))]
+    if moments[0].ndim == 2:
+        # Grayscale input: give the reduction the channel axis it expects
+        moments = [m[..., None] for m in moments]
+
+    return float(ssim_reduce(*moments, C1, C2))
+
+
+####################
+# GPU metrics
+####################
+
+
+def to_gpu(images):
+    """Upload same-shape HxWx3 uint8 images as one Nx3xHxW float32 CUDA tensor"""
+    # Pack the images into a single pinned [N,H,W,3] buffer so the batch is one transfer
+    batch = torch.empty((len(images),) + images[0].shape, dtype=torch.uint8).pin_memory()
+    batch_view = batch.numpy()
+    for i, img in enumerate(images):
+        batch_view[i] = img
+    # Cast on the device so only the uint8 bytes cross the bus
+    return batch.to('cuda', non_blocking=True).permute(0, 3, 1, 2).float()
+
+
+def gpu_metrics(batch_ref, batch_img, data_range=255):
+    """Calculate per-image PSNR and SSIM for two [N,3,H,W] CUDA tensors"""
+    mse = (batch_ref - batch_img).pow(2).mean(dim=(1, 2, 3))
+    batch_psnr = 10 * torch.log10(data_range ** 2 / mse)
+    batch_ssim = gpu_ssim(batch_ref, batch_img, data_range=data_range, size_average=False)
+    return batch_psnr.tolist(), batch_ssim.tolist()
+
+
+def _score_cpu(ref, img, name):
+    """(PSNR, SSIM) of one pair on the CPU, or None with the error logged"""
+    try:
+        return fast_psnr(ref, img), fast_ssim(ref, img)
+    except Exception as e:
+        logger.error("Error calculating metrics for %s: %s", name, e)
+        return None
+
+
+def score_gpu_batch(bucket, results, names):
+    """Score a bucket of same-shape (index, ref, img) pairs in one GPU call into results[index] and empty it
+
+    If the call fails (e.g. CUDA out of memory) the pairs are retried one at a time,
+    then on the CPU; pairs that still fail get None. names[index] labels the log messages
+    """
+    try:
+        batch_psnr, batch_ssim = gpu_metrics(to_gpu([ref for _, ref, _ in bucket]),
+                                             to_gpu([img for _, _, img in bucket]))
+    except Exception as e:
+        error = str(e)
+    else:
+        for (index, _, _), current_psnr, current_ssim in zip(bucket, batch_psnr, batch_ssim):
+            results[index] = (current_psnr, current_ssim)
+        bucket.clear()
+        return
+
+    # Retry outside the except block, once the traceback no longer holds the failed batch
+    torch.cuda.empty_cache()
+    if len(bucket) > 1:
+        logger.warning("GPU batch of %d pairs failed (%s), scoring them one at a time", len(bucket), error)
+        for pair in bucket:
+            score_gpu_batch([pair], results, names)
+    else:
+        index, ref, img = bucket[0]
+        logger.warning("GPU scoring failed for %s (%s), using the CPU", names[index], error)
+        results[index] = _score_cpu(ref, img, names[index])
+    bucket.clear()
+
+
+def score_gpu_batches(image_pairs, names):
+    """Yield (PSNR, SSIM), or None, for each (ref, img) pair or None in order, scoring same-shape pairs in GPU batches
+
+    names[index] labels the pair in error messages
+    """
+    results = {}  # index -> scores not yet yielded
+    buckets = {}  # shape -> (index, ref, img) pairs waiting for a GPU batch
+    pending = 0
+    next_index = 0
+    for index, images in enumerate(image_pairs):
+        if images is None:
+            results[index] = None
+        else:
+            ref, img = images
+            try:
+                check_ssim_size(ref)
+            except ValueError as e:
+                logger.error("Error calculating metrics for %s: %s", names[index], e)
+                results[index] = None
+            else:
+                # Group pairs by shape so every GPU call scores a full [N,3,H,W] batch
+                bucket = buckets.setdefault(ref.shape, [])
+                bucket.append((index, ref, img))
+                pending += 1
+                if len(bucket) == GPU_BATCH_SIZE:
+                    pending -= len(bucket)
+                    score_gpu_batch(bucket, results, names)
+                elif pending > GPU_MAX_PENDING:
+                    # Too many pairs of rare shapes are waiting: score the bucket holding the oldest one
+                    oldest = min((b for b in buckets.values() if b), key=lambda b: b[0][0])
+                    pending -= len(oldest)
+                    score_gpu_batch(oldest, results, names)
+
+        # Hand back every result whose predecessors are all scored
+        while next_index in results:
+            yield results.pop(next_index)
+            next_index += 1
+
+    # Score the leftover buckets oldest first, yielding as soon as each frees the next index
+    for bucket in sorted((b for b in buckets.values() if b), key=lambda b: b[0][0]):
+        score_gpu_batch(bucket, results, names)
+        while next_index in results:
+            yield results.pop(next_index)
+            next_index += 1
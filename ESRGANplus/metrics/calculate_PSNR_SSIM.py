@@ -119,6 +119,10 @@ def calculate_ssim(img1, img2):
         raise ValueError('Wrong input image dimensions.')
 
 
+# BGR -> Y row of matlab's rgb2ycbcr for [0, 1] images, with the +16 offset as last column
+_Y_ROW = np.array([[24.966, 128.553, 65.481, 16.0]]) / 255.
+
+
 def bgr2ycbcr(img, only_y=True):
     '''same as matlab rgb2ycbcr
     only_y: only return Y channel
@@ -127,6 +131,11 @@ def bgr2ycbcr(img, only_y=True):
         float, [0, 1]
     '''
     in_img_type = img.dtype
+    if only_y and in_img_type != np.uint8:
+        # Y row of the matrix only, offset in the last column: one cv2.transform pass
+        # instead of scaling to [0, 255], np.dot, offset and scaling back.
+        # uint8 input keeps the path below so its rounding stays exactly MATLAB's
+        return cv2.transform(img, _Y_ROW.astype(in_img_type))
     img.astype(np.float32)
     if in_img_type != np.uint8:
         img *= 255.
@@ -1,25 +1,66 @@
 import os
-import cv2
+import sys
+import logging
 import numpy as np
-from skimage.metrics import structural_similarity as ssim
-from skimage.metrics import peak_signal_noise_ratio as psnr
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metric_utils import (USE_GPU, is_image_name, read_image, read_cached_image, resize_like,
+                          prefetch, setup_logging, fast_psnr, fast_ssim, score_gpu_batches)
 
-def validate_directories(output_dir, gt_dir):
-    """Validate that directories exist and contain images."""
+logger = logging.getLogger(__name__)
+
+def read_pair(out_path, gt_path):
+    """Decode an output image and its (cached) ground truth; runs on a prefetch thread."""
+    return read_image(out_path), read_cached_image(gt_path)
+
+def load_image_pairs(filenames, path_pairs, resize_buffers=None):
+    """Yield same-sized (gt, out) images for each (out_path, gt_path) pair in order, or None if unreadable."""
+    # Decode upcoming images on background threads while the current pair is scored
+    for filename, (out_path, gt_path), (img_out, img_gt) in zip(filenames, path_pairs, prefetch(read_pair, path_pairs)):
+        if img_out is None:
+            logger.warning("Could not read output image: %s", out_path)
+            yield None
+            continue
+        if img_gt is None:
+            logger.warning("Could not read ground truth image: %s", gt_path)
+            yield None
+            continue
+        
+        # Make sure images are the same size
+        if img_out.shape != img_gt.shape:
+            logger.debug("Resizing %s to match GT dimensions", filename)
+            img_out = resize_like(img_out, img_gt, resize_buffers)
+        
+        yield img_gt, img_out
+
+def find_image_pairs(output_dir, gt_dir):
+    """Validate both directories and return sorted (filename, out_path, gt_path) for images present in both."""
     if not os.path.exists(gt_dir):
         raise FileNotFoundError(f"Ground truth directory not found: {gt_dir}")
     if not os.path.exists(output_dir):
         raise FileNotFoundError(f"Output directory not found: {output_dir}")
-        
-    gt_files = [f for f in os.listdir(gt_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
-    output_files = [f for f in os.listdir(output_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
     
-    if not gt_files:
+    # One scan per directory: index the outputs by name, then match GT entries as they are listed
+    with os.scandir(output_dir) as entries:
+        output_paths = {e.name: e.path for e in entries if e.is_file() and is_image_name(e.name)}
+    
+    num_gt = 0
+    pairs = []
+    with os.scandir(gt_dir) as entries:
+        for e in entries:
+            if e.is_file() and is_image_name(e.name):
+                num_gt += 1
+                if e.name in output_paths:
+                    pairs.append((e.name, output_paths[e.name], e.path))
+    
+    if not num_gt:
         raise ValueError(f"No images found in ground truth directory: {gt_dir}")
-    if not output_files:
+    if not output_paths:
         raise ValueError(f"No images found in output directory: {output_dir}")
-        
-    return output_files, gt_files
+    if not pairs:
+        raise ValueError("No matching image files found between output and GT directories")
+    
+    pairs.sort()
+    return pairs
 
 def calculate_metrics(output_dir, gt_dir):
     """
@@ -33,50 +74,32 @@ def calculate_metrics(output_dir, gt_dir):
         Dictionary with average PSNR and SSIM values
     """
     try:
-        output_files, gt_files = validate_directories(output_dir, gt_dir)
-        
         # Match files that exist in both directories
-        common_files = set(output_files) & set(gt_files)
-        if not common_files:
-            raise ValueError("No matching image files found between output and GT directories")
-            
+        pairs = find_image_pairs(output_dir, gt_dir)
+        filenames = [filename for filename, _, _ in pairs]
+        path_pairs = [(out_path, gt_path) for _, out_path, gt_path in pairs]
+        # GPU buckets keep their images, so only the CPU path can reuse resize buffers
+        resize_buffers = None if USE_GPU else {}
+        images = load_image_pairs(filenames, path_pairs, resize_buffers)
+        
+        if USE_GPU:
+            scores = score_gpu_batches(images, filenames)
+        else:
+            # Calculate metrics
+            scores = (None if pair is None else (fast_psnr(*pair), fast_ssim(*pair)) for pair in images)
+        
         psnr_values = []
         ssim_values = []
         processed_files = []
-        
-        for filename in sorted(common_files):
-            # Read images
-            out_path = os.path.join(output_dir, filename)
-            gt_path = os.path.join(gt_dir, filename)
-            
-            img_out = cv2.imread(out_path)
-            img_gt = cv2.imread(gt_path)
-            
-            if img_out is None:
-                print(f"Warning: Could not read output image: {out_path}")
-                continue
-            if img_gt is None:
-                print(f"Warning: Could not read ground truth image: {gt_path}")
+        for filename, result in zip(filenames, scores):
+            if result is None:
                 continue
-            
-            # Make sure images are the same size
-            if img_out.shape != img_gt.shape:
-                print(f"Resizing {filename} to match GT dimensions")
-                img_out = cv2.resize(img_out, (img_gt.shape[1], img_gt.shape[0]))
-            
-            # Convert to float32 for calculations
-            img_out = img_out.astype(np.float32)
-            img_gt = img_gt.astype(np.float32)
-            
-            # Calculate metrics
-            current_psnr = psnr(img_gt, img_out, data_range=255)
-            current_ssim = ssim(img_gt, img_out, data_range=255, channel_axis=2)
-            
+            current_psnr, current_ssim = result
             psnr_values.append(current_psnr)
             ssim_values.append(current_ssim)
             processed_files.append(filename)
             
-            print(f"{filename} - PSNR: {current_psnr:.2f} dB, SSIM: {current_ssim:.4f}")
+            logger.debug("%s - PSNR: %.2f dB, SSIM: %.4f", filename, current_psnr, current_ssim)
         
         if not psnr_values:
             raise ValueError("No valid image pairs were processed")
@@ -103,6 +126,8 @@ def calculate_metrics(output_dir, gt_dir):
         return None
 
 if __name__ == "__main__":
+    setup_logging(logger)
+    
     # Set paths relative to the script location
     script_dir = os.path.dirname(os.path.abspath(__file__))
     output_directory = os.path.join(script_dir, "results")